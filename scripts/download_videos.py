@@ -1,53 +1,150 @@
 import argparse
-import json
+import bisect
+import hashlib
+import io
 import os
 import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
-from contextlib import contextmanager
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import random
 
-from huggingface_hub import HfApi, snapshot_download
-from huggingface_hub.utils import (
-    HfHubHTTPError,
-    are_progress_bars_disabled,
-    disable_progress_bars,
-    enable_progress_bars,
-)
+import numpy as np
+import orjson
+from huggingface_hub import CommitOperationAdd, HfApi, hf_hub_download, snapshot_download
+from huggingface_hub.utils import HfHubHTTPError, disable_progress_bars
+from huggingface_hub.utils._runtime import is_xet_available
 from tqdm import tqdm
 
+try:
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadError
+except ImportError:
+    YoutubeDL = None
+
 DEFAULT_DISPATCH_INTERVAL_SECONDS = 2.0
+MAX_COMPLETION_WAIT_SECONDS = 1.0
 INDEX_REFRESH_SECONDS = 60.0
+POSTFIX_INTERVAL_SECONDS = 0.25
+GIB = 1024 * 1024 * 1024
 DEFAULT_UPLOAD_REFERENCE_GB = 7.0
 TQDM_FORMAT = "{desc}: {percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}] {postfix}"
 YT_INDEX_NAME = "yt_index.json"
+MAX_INDEX_DOWNLOAD_WORKERS = 32
+TAR_STREAM_BUFFER_SIZE = 8 * 1024 * 1024
 
 
-@contextmanager
-def hf_quiet():
-    previously_disabled = are_progress_bars_disabled()
-    disable_progress_bars()
-    try:
-        yield
-    finally:
-        if not previously_disabled:
-            enable_progress_bars()
+def encode_names(names):
+    return np.array([name.encode() for name in names], dtype=bytes)
+
+
+class NameSet:
+    """Set of file names kept as a sorted numpy byte-string array plus a small set of recent additions."""
+
+    def __init__(self, names=()):
+        self._sorted = np.unique(encode_names(names))
+        self._recent = set()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        name_set = cls()
+        arrays = list(arrays)
+        if arrays:
+            name_set._sorted = np.unique(np.concatenate(arrays))
+        return name_set
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, name):
+        if name in self._recent:
+            return True
+        # Other threads swap in a new _sorted array, so read it once.
+        sorted_names = self._sorted
+        key = name.encode()
+        index = sorted_names.searchsorted(key)
+        return index < len(sorted_names) and sorted_names[index] == key
+
+    def _contains_keys(self, keys):
+        sorted_names = self._sorted
+        if not len(sorted_names) or not len(keys):
+            return np.zeros(len(keys), dtype=bool)
+        index = sorted_names.searchsorted(keys)
+        np.minimum(index, len(sorted_names) - 1, out=index)
+        return sorted_names[index] == keys
+
+    def contains(self, names):
+        self.compact()
+        return self._contains_keys(encode_names(names)).tolist()
+
+    def intersection(self, names):
+        names = list(names)
+        return {name for name, found in zip(names, self.contains(names)) if found}
+
+    def update(self, names):
+        self._recent.update(name for name in names if name not in self)
+
+    def merge(self, arrays):
+        self.compact()
+        if not arrays:
+            return 0
+        keys = np.unique(np.concatenate(arrays))
+        keys = keys[~self._contains_keys(keys)]
+        if len(keys):
+            merged = self._sorted
+            if merged.itemsize < keys.itemsize:
+                merged = merged.astype(keys.dtype)
+            self._sorted = np.insert(merged, merged.searchsorted(keys), keys)
+        return len(keys)
+
+    def compact(self):
+        if self._recent:
+            # Readers check _recent first, so publish the merged array before clearing it.
+            self._sorted = np.union1d(self._sorted, encode_names(self._recent))
+            self._recent = set()
+
+
+class SilentLogger:
+    """yt-dlp logger that drops every message."""
+
+    def debug(self, message):
+        pass
+
+    info = warning = error = debug
 
 
 def load_index_file(path):
-    with open(path, "r") as handle:
-        data = json.load(handle)
-    if isinstance(data, list):
-        return set(data)
-    if isinstance(data, dict):
-        return set(data.keys())
+    with open(path, "rb") as handle:
+        data = orjson.loads(handle.read())
+    if isinstance(data, (list, dict)):
+        return encode_names(data)
     raise ValueError(f"Remote index {path} must be a JSON array or object.")
 
 
+def file_sha256(path):
+    with open(path, "rb") as handle:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(handle, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def load_remote_index(repo_id, repo_type, index_path, revision):
+    local_path = hf_hub_download(
+        repo_id=repo_id,
+        filename=index_path,
+        repo_type=repo_type,
+        revision=revision,
+    )
+    return load_index_file(local_path)
+
+
 def load_yt_index(repo_id, repo_type):
     snapshot_path = snapshot_download(
         repo_id=repo_id,
@@ -55,8 +152,8 @@ def load_yt_index(repo_id, repo_type):
         allow_patterns=[YT_INDEX_NAME],
     )
     index_path = os.path.join(snapshot_path, YT_INDEX_NAME)
-    with open(index_path, "r") as handle:
-        index_data = json.load(handle)
+    with open(index_path, "rb") as handle:
+        index_data = orjson.loads(handle.read())
     if not isinstance(index_data, list):
         raise ValueError(f"{YT_INDEX_NAME} must be a JSON array.")
     return index_data
@@ -67,15 +164,15 @@ def split_repo_files(repo_files):
     index_numbers = []
     index_files = []
     for path in repo_files:
-        if path.startswith("videos/part_") and path.endswith(".tar"):
-            number_text = path[len("videos/part_") : -len(".tar")]
-            if number_text.isdigit():
-                tar_numbers.append(int(number_text))
-            continue
-        if path.startswith("index/") and path.endswith(".json"):
+        if path.endswith(".tar"):
+            if path.startswith("videos/part_"):
+                number_text = path.removeprefix("videos/part_").removesuffix(".tar")
+                if number_text.isdigit():
+                    tar_numbers.append(int(number_text))
+        elif path.endswith(".json") and path.startswith("index/"):
             index_files.append(path)
             if path.startswith("index/part_"):
-                number_text = path[len("index/part_") : -len(".json")]
+                number_text = path.removeprefix("index/part_").removesuffix(".json")
                 if number_text.isdigit():
                     index_numbers.append(int(number_text))
     return tar_numbers, index_numbers, index_files
@@ -86,10 +183,108 @@ def next_part_number(tar_numbers, index_numbers):
     return max(all_numbers) + 1 if all_numbers else 0
 
 
-def build_tar(tar_path, file_paths):
-    with tarfile.open(tar_path, "w") as tar:
+class TarStream(io.RawIOBase):
+    """Seekable tar of `file_paths`, byte-identical to tarfile's output, read from the files on demand."""
+
+    def __init__(self, file_paths):
+        super().__init__()
+        builder = tarfile.TarFile(fileobj=io.BytesIO(), mode="w")
+        self._starts = []
+        self._segments = []
+        offset = 0
         for path in file_paths:
-            tar.add(path, arcname=os.path.basename(path))
+            info = builder.gettarinfo(path, arcname=os.path.basename(path))
+            header = info.tobuf(builder.format, builder.encoding, builder.errors)
+            offset = self._append(offset, len(header), header)
+            offset = self._append(offset, info.size, path)
+            offset = self._append(offset, -info.size % tarfile.BLOCKSIZE, None)
+        end_size = offset + 2 * tarfile.BLOCKSIZE
+        end_size += -end_size % tarfile.RECORDSIZE
+        self._size = self._append(offset, end_size - offset, None)
+        self._position = 0
+        self._handle_path = None
+        self._handle = None
+
+    def _append(self, offset, length, source):
+        if length:
+            self._starts.append(offset)
+            self._segments.append((offset, length, source))
+        return offset + length
+
+    def _open(self, path):
+        if self._handle_path != path:
+            if self._handle is not None:
+                self._handle.close()
+            self._handle = open(path, "rb", buffering=0)
+            self._handle_path = path
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self._handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return self._handle
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence: {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view) and self._position < self._size:
+            index = bisect.bisect_right(self._starts, self._position) - 1
+            start, length, source = self._segments[index]
+            skip = self._position - start
+            count = min(length - skip, len(view) - filled)
+            target = view[filled : filled + count]
+            if source is None:
+                target[:] = bytes(count)
+            elif isinstance(source, bytes):
+                target[:] = source[skip : skip + count]
+            else:
+                if hasattr(os, "preadv"):
+                    count = os.preadv(self._open(source).fileno(), [target], skip)
+                else:
+                    handle = self._open(source)
+                    handle.seek(skip)
+                    count = handle.readinto(target)
+                if not count:
+                    raise OSError(f"{source} shrank while it was being archived.")
+            filled += count
+            self._position += count
+        return filled
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+            self._handle_path = None
+        super().close()
+
+
+def write_tar(file_paths, directory):
+    handle, tar_path = tempfile.mkstemp(prefix=".upload_", suffix=".tar", dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as target, TarStream(file_paths) as source:
+            shutil.copyfileobj(source, target, TAR_STREAM_BUFFER_SIZE)
+    except BaseException:
+        os.remove(tar_path)
+        raise
+    return tar_path
 
 
 def main():
@@ -102,115 +297,165 @@ def main():
     parser.add_argument("--upload-reference-gb", type=float, default=DEFAULT_UPLOAD_REFERENCE_GB)
     parser.add_argument("--dispatch-interval", type=float, default=DEFAULT_DISPATCH_INTERVAL_SECONDS)
     parser.add_argument("--index-dir", default="index", type=str)
+    parser.add_argument(
+        "--legacy-subprocess",
+        action="store_true",
+        help="Run the yt-dlp command once per video instead of the in-process yt_dlp library.",
+    )
     args = parser.parse_args()
 
     jobs = args.jobs if args.jobs and args.jobs > 0 else 1
     api = HfApi()
     api.create_repo(args.hf_repo, repo_type=args.repo_type, exist_ok=True)
 
-    if shutil.which("yt-dlp") is None:
-        print("yt-dlp is required to download videos. Please install it first.", file=sys.stderr)
+    if args.legacy_subprocess:
+        if shutil.which("yt-dlp") is None:
+            print("yt-dlp is required to download videos. Please install it first.", file=sys.stderr)
+            sys.exit(1)
+    elif YoutubeDL is None:
+        print("The yt_dlp package could not be imported. Install it or pass --legacy-subprocess.", file=sys.stderr)
         sys.exit(1)
 
     os.makedirs(args.video_path, exist_ok=True)
-    threshold_bytes = int(args.upload_threshold_gb * 1024 * 1024 * 1024)
-    reference_bytes = int(args.upload_reference_gb * 1024 * 1024 * 1024)
+    video_dir = os.path.join(args.video_path, "")
+    local_sizes = {
+        entry.name: entry.stat().st_size for entry in os.scandir(args.video_path) if entry.is_file()
+    }
+    # Fresh downloads are hashed on their download thread; older files by the uploader.
+    file_digests = {}
+    use_xet = is_xet_available()
+    threshold_bytes = int(args.upload_threshold_gb * GIB)
+    reference_bytes = int(args.upload_reference_gb * GIB)
     if reference_bytes > threshold_bytes:
         reference_bytes = threshold_bytes
 
     print(f"Loading {YT_INDEX_NAME}.")
     video_names = load_yt_index(args.hf_repo, args.repo_type)
-    youtube_video_format = "https://www.youtube.com/watch?v={}"
-
-    batch_entries = []
-    batch_names = set()
+    # Hub calls run on several threads from here on, so their progress bars stay off for the run.
+    disable_progress_bars()
+    youtube_video_prefix = "https://www.youtube.com/watch?v="
+    ydl_options = {
+        "format": "134",
+        "outtmpl": os.path.join(args.video_path.replace("%", "%%"), "%(id)s.mp4"),
+        "continuedl": True,
+        "noprogress": True,
+        "no_warnings": True,
+        "quiet": True,
+        "logger": SilentLogger(),
+    }
+    ydl_local = threading.local()
+
+    batch = {}
     batch_size = 0
     post_skip_count = 0
     last_indexing_delay = 0.0
     last_index_refresh = 0.0
     last_index_sha = None
-    last_repo_files = []
-    last_remote_files = set()
-
-    def add_to_batch(path):
+    next_part = 0
+    last_remote_files = NameSet()
+    index_revisions = {}
+    # huggingface_hub keeps one HTTP session per thread, so reused threads keep their connections.
+    index_executor = ThreadPoolExecutor(max_workers=MAX_INDEX_DOWNLOAD_WORKERS)
+    upload_future = None
+    # Lock order is index_lock, then batch_lock.
+    batch_lock = threading.RLock()
+    index_lock = threading.RLock()
+
+    def add_to_batch(name, path):
         nonlocal batch_size
-        if not os.path.exists(path):
-            return False
-        name = os.path.basename(path)
-        if name in batch_names:
-            return False
-        size = os.path.getsize(path)
+        size = local_sizes.get(name)
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return False
+            local_sizes[name] = size
         if size <= 0:
             return False
-        batch_entries.append({"name": name, "path": path, "size": size})
-        batch_names.add(name)
-        batch_size += size
+        with batch_lock:
+            if name in batch:
+                return False
+            batch[name] = (path, size)
+            batch_size += size
         return True
 
     def remove_entries(names, count_post_skip=False):
-        nonlocal batch_entries, batch_size, post_skip_count
-        if not names or not batch_entries:
-            return 0
-        remaining = []
-        removed = 0
-        for entry in batch_entries:
-            if entry["name"] in names:
-                removed += 1
-                batch_size -= entry["size"]
-                batch_names.discard(entry["name"])
-            else:
-                remaining.append(entry)
-        if removed:
-            batch_entries = remaining
+        nonlocal batch_size, post_skip_count
+        with batch_lock:
+            names = names.intersection(batch)
+            for name in names:
+                batch_size -= batch.pop(name)[1]
             if count_post_skip:
-                post_skip_count += removed
-        return removed
+                post_skip_count += len(names)
+            return len(names)
+
+    def load_indexes(index_files, revisions):
+        return list(
+            index_executor.map(
+                lambda index_path: load_remote_index(args.hf_repo, args.repo_type, index_path, revisions[index_path]),
+                index_files,
+            )
+        )
+
+    def load_new_indexes(index_files, revision):
+        # Part indexes are never rewritten, so each is loaded once, at the revision it was first listed at.
+        new_index_files = [index_path for index_path in index_files if index_path not in index_revisions]
+        new_indexes = load_indexes(new_index_files, dict.fromkeys(new_index_files, revision))
+        index_revisions.update(dict.fromkeys(new_index_files, revision))
+        return new_indexes
 
     def refresh_indexes(force=False):
-        nonlocal last_remote_files, last_index_refresh, last_index_sha, last_repo_files, last_indexing_delay
         now = time.monotonic()
         if not force and now - last_index_refresh < INDEX_REFRESH_SECONDS:
             return False
+        if not index_lock.acquire(blocking=force):
+            return False
+        try:
+            return refresh_indexes_locked(now)
+        finally:
+            index_lock.release()
+
+    def refresh_indexes_locked(now):
+        nonlocal last_remote_files, last_index_refresh, last_index_sha, next_part, last_indexing_delay
         curr_index_sha = api.repo_info(args.hf_repo, repo_type=args.repo_type).sha
+        if curr_index_sha == last_index_sha:
+            last_indexing_delay = time.monotonic() - now
+            last_index_refresh = now
+            return False
         curr_repo_files = api.list_repo_files(
             args.hf_repo,
             repo_type=args.repo_type,
             revision=curr_index_sha,
         )
-        _, _, index_files = split_repo_files(curr_repo_files)
-
-        curr_remote_files = set()
-        if index_files:
-            with hf_quiet():
-                snapshot_path = snapshot_download(
-                    repo_id=args.hf_repo,
-                    repo_type=args.repo_type,
-                    revision=curr_index_sha,
-                    allow_patterns=index_files,
-                )
-                for index_path in index_files:
-                    local_path = os.path.join(snapshot_path, index_path)
-                    index_data = load_index_file(local_path)
-                    curr_remote_files.update(index_data)
-
-        changed = curr_remote_files != last_remote_files
+        tar_numbers, index_numbers, index_files = split_repo_files(curr_repo_files)
+
+        new_indexes = load_new_indexes(index_files, curr_index_sha)
+        if len(index_revisions) == len(index_files):
+            curr_remote_files = last_remote_files
+            changed = curr_remote_files.merge(new_indexes) > 0
+        else:
+            # An index was deleted. The rest are reread at their pinned revisions, which the Hub cache serves.
+            for index_path in set(index_revisions).difference(index_files):
+                del index_revisions[index_path]
+            curr_remote_files = NameSet.from_arrays(load_indexes(index_files, index_revisions))
+            changed = True
         removed = remove_entries(curr_remote_files, count_post_skip=True)
 
         last_indexing_delay = time.monotonic() - now
         last_index_refresh = now
         last_index_sha = curr_index_sha
-        last_repo_files = curr_repo_files
+        next_part = max(next_part, next_part_number(tar_numbers, index_numbers))
         last_remote_files = curr_remote_files
         return changed or removed > 0
 
     def select_entries(target_bytes):
         selected = []
         total = 0
-        for entry in batch_entries:
+        for name, (path, size) in batch.items():
             if total >= target_bytes:
                 break
-            selected.append(entry)
-            total += entry["size"]
+            selected.append((name, path, size))
+            total += size
         return selected, total
 
     def is_conflict_error(exc):
@@ -218,88 +463,155 @@ def main():
             return False
         return exc.response.status_code in (409, 412)
 
-    def attempt_upload(final=False):
-        nonlocal post_skip_count
-        while True:
-            refresh_indexes(force=True)
-            if not batch_entries or (not final and batch_size < reference_bytes):
-                return False
-            tar_numbers, index_numbers, _ = split_repo_files(last_repo_files)
-            part_number = next_part_number(tar_numbers, index_numbers)
-            tar_name = f"part_{part_number:04d}.tar"
-            index_path = os.path.join(args.index_dir, tar_name.replace(".tar", ".json"))
-            selected, total_bytes = select_entries(threshold_bytes)
-            if total_bytes < (0 if final else reference_bytes):
-                return False
-            selected_names = [entry["name"] for entry in selected]
-            selected_sizes = {entry["name"]: entry["size"] for entry in selected}
-
-            temp_dir = tempfile.mkdtemp(prefix="hf_upload_")
-            temp_videos = os.path.join(temp_dir, "videos")
-            temp_index_dir = os.path.join(temp_dir, "index")
-            os.makedirs(temp_videos, exist_ok=True)
-            os.makedirs(temp_index_dir, exist_ok=True)
-
-            tar_path = os.path.join(temp_videos, tar_name)
-            build_tar(tar_path, [entry["path"] for entry in selected])
-
-            temp_index = os.path.join(temp_index_dir, os.path.basename(index_path))
-            with open(temp_index, "w") as handle:
-                json.dump(selected_sizes, handle, indent=0, ensure_ascii=False)
-
-            try:
-                parent_sha = last_index_sha
-                with hf_quiet():
-                    api.upload_folder(
-                        folder_path=temp_dir,
-                        path_in_repo="",
+    def take_entries():
+        with batch_lock:
+            selected, _ = select_entries(threshold_bytes)
+            remove_entries({name for name, _, _ in selected})
+        return selected
+
+    def attempt_upload(selected, final=False):
+        nonlocal post_skip_count, last_index_sha, next_part
+        tar_operation = None
+        tar_operation_names = None
+        conflicted = False
+        tar_path = None
+        try:
+            while True:
+                # parent_commit rejects a stale view, so only a conflict forces a refresh.
+                refresh_indexes(force=conflicted)
+                with index_lock:
+                    remaining = [entry for entry in selected if entry[0] not in last_remote_files]
+                    part_number = next_part
+                    parent_sha = last_index_sha
+                with batch_lock:
+                    post_skip_count += len(selected) - len(remaining)
+                selected = remaining
+                if not selected:
+                    return False
+                if not final and sum(size for _, _, size in selected) < reference_bytes:
+                    for name, path, _ in selected:
+                        add_to_batch(name, path)
+                    return False
+                tar_name = f"part_{part_number:04d}.tar"
+                index_path = os.path.join(args.index_dir, tar_name.replace(".tar", ".json"))
+                selected_names = [name for name, _, _ in selected]
+                unhashed = [(name, path) for name, path, _ in selected if name not in file_digests]
+                if unhashed:
+                    with ThreadPoolExecutor(max_workers=min(jobs, len(unhashed))) as hash_executor:
+                        digests = hash_executor.map(file_sha256, [path for _, path in unhashed])
+                        file_digests.update(zip([name for name, _ in unhashed], digests))
+                selected_index = {name: {"size": size, "sha256": file_digests[name]} for name, _, size in selected}
+
+                if tar_operation is not None and tar_operation_names == selected_names:
+                    # The rejected commit's tar is already on the Hub; only its path changes.
+                    tar_operation.path_in_repo = f"videos/{tar_name}"
+                else:
+                    if tar_path is not None:
+                        os.remove(tar_path)
+                        tar_path = None
+                    file_paths = [path for _, path, _ in selected]
+                    if use_xet:
+                        # Xet only uploads from paths; a stream would fall back to plain LFS over HTTP.
+                        tar_path = write_tar(file_paths, args.video_path)
+                        tar_source = tar_path
+                    else:
+                        tar_source = io.BufferedReader(TarStream(file_paths), buffer_size=TAR_STREAM_BUFFER_SIZE)
+                    try:
+                        tar_operation = CommitOperationAdd(path_in_repo=f"videos/{tar_name}", path_or_fileobj=tar_source)
+                        api.preupload_lfs_files(
+                            args.hf_repo,
+                            additions=[tar_operation],
+                            repo_type=args.repo_type,
+                        )
+                    finally:
+                        if tar_path is None:
+                            tar_source.close()
+                    tar_operation_names = selected_names
+
+                operations = [
+                    tar_operation,
+                    CommitOperationAdd(path_in_repo=index_path, path_or_fileobj=orjson.dumps(selected_index)),
+                ]
+                try:
+                    commit_info = api.create_commit(
                         repo_id=args.hf_repo,
                         repo_type=args.repo_type,
+                        operations=operations,
                         parent_commit=parent_sha,
                         commit_message=f"Upload videos/{tar_name} and {index_path}",
                     )
-            except HfHubHTTPError as exc:
-                if is_conflict_error(exc):
-                    continue
-                raise
-            finally:
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                except HfHubHTTPError as exc:
+                    if is_conflict_error(exc):
+                        conflicted = True
+                        continue
+                    raise
 
-            print(f"Upload complete: videos/{tar_name} -> {index_path}")
-            remove_entries(set(selected_names))
-            last_remote_files.update(selected_names)
-            return True
+                print(f"Upload complete: videos/{tar_name} -> {index_path}")
+                with index_lock:
+                    last_index_sha = commit_info.oid
+                    next_part = max(next_part, part_number + 1)
+                    last_remote_files.update(selected_names)
+                for name in selected_names:
+                    file_digests.pop(name, None)
+                return True
+
+        finally:
+            if tar_path is not None:
+                os.remove(tar_path)
 
     def maybe_flush():
+        nonlocal upload_future
+        if upload_future is not None:
+            if not upload_future.done():
+                return
+            upload_future.result()
+            upload_future = None
         if batch_size >= threshold_bytes:
-            attempt_upload(final=False)
+            upload_future = upload_executor.submit(attempt_upload, take_entries(), False)
 
     def download_one(video_name):
-        url = youtube_video_format.format(video_name)
-        file_path = os.path.join(args.video_path, f"{video_name}.mp4")
-        if os.path.exists(file_path):
+        url = youtube_video_prefix + video_name
+        filename = f"{video_name}.mp4"
+        file_path = video_dir + filename
+        if filename in local_sizes:
             return video_name, "skipped", file_path
+        if args.legacy_subprocess:
+            try:
+                subprocess.run(
+                    [
+                        "yt-dlp",
+                        "-c",
+                        "--no-progress",
+                        "--no-warnings",
+                        "--quiet",
+                        "-o",
+                        file_path,
+                        "-f",
+                        "134",
+                        url,
+                    ],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except subprocess.CalledProcessError as exc:
+                return video_name, "failed", exc
+        else:
+            ydl = getattr(ydl_local, "ydl", None)
+            if ydl is None:
+                ydl = ydl_local.ydl = YoutubeDL(ydl_options)
+            try:
+                ydl.download([url])
+            except DownloadError as exc:
+                return video_name, "failed", exc
         try:
-            subprocess.run(
-                [
-                    "yt-dlp",
-                    "-c",
-                    "--no-progress",
-                    "--no-warnings",
-                    "--quiet",
-                    "-o",
-                    file_path,
-                    "-f",
-                    "134",
-                    url,
-                ],
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-            return video_name, "downloaded", file_path
-        except subprocess.CalledProcessError as exc:
+            size = os.path.getsize(file_path)
+            digest = file_sha256(file_path)
+        except OSError as exc:
             return video_name, "failed", exc
+        local_sizes[filename] = size
+        file_digests[filename] = digest
+        return video_name, "downloaded", file_path
 
     success_count = 0
     fail_count = 0
@@ -308,7 +620,7 @@ def main():
     next_dispatch_time = time.monotonic() + dispatch_interval
 
     def status_text():
-        pending_gb = batch_size / (1024 * 1024 * 1024)
+        pending_gb = batch_size / GIB
         return (
             f"success={success_count} "
             f"fail={fail_count} "
@@ -318,18 +630,39 @@ def main():
             f"indexing_delay={last_indexing_delay:.1f}"
         )
 
-    def refresh_if_due(progress):
-        if refresh_indexes(force=False):
+    last_postfix_time = 0.0
+
+    def maybe_postfix(progress, force=False):
+        nonlocal last_postfix_time
+        now = time.monotonic()
+        if force or now - last_postfix_time >= POSTFIX_INTERVAL_SECONDS:
             progress.set_postfix_str(status_text(), refresh=False)
+            last_postfix_time = now
 
-    def wait_for_dispatch(*callbacks):
+    refresh_future = None
+
+    def refresh_if_due(progress):
+        nonlocal refresh_future
+        if refresh_future is not None:
+            if not refresh_future.done():
+                return
+            if refresh_future.result():
+                maybe_postfix(progress)
+            refresh_future = None
+        if time.monotonic() - last_index_refresh >= INDEX_REFRESH_SECONDS:
+            refresh_future = refresh_executor.submit(refresh_indexes, False)
+
+    def wait_for_dispatch(collect, *callbacks):
         nonlocal next_dispatch_time
         if dispatch_interval <= 0:
             return
-        while time.monotonic() <= next_dispatch_time:
+        while True:
+            remaining = next_dispatch_time - time.monotonic()
+            if remaining <= 0:
+                break
             for f in callbacks:
                 f()
-            time.sleep(0.2)
+            collect(timeout=min(remaining, MAX_COMPLETION_WAIT_SECONDS))
         next_dispatch_time = max(
             next_dispatch_time + dispatch_interval,
             time.monotonic() + dispatch_interval,
@@ -337,89 +670,103 @@ def main():
 
     refresh_indexes(force=True)
     random.shuffle(video_names)
+    mp4_names = [name + ".mp4" for name in video_names]
+    pending_names = [
+        (name, filename)
+        for name, filename, is_remote in zip(video_names, mp4_names, last_remote_files.contains(mp4_names))
+        if not is_remote
+    ]
+    local_files = [
+        (filename, video_dir + filename)
+        for _, filename in pending_names
+        if filename in local_sizes
+    ]
+    download_names = [(name, filename) for name, filename in pending_names if filename not in local_sizes]
+    skip_count = len(video_names) - len(pending_names)
     with tqdm(
-        total=len(video_names),
+        total=len(pending_names),
         ncols=120,
         desc="Downloading videos",
         mininterval=10,
         bar_format=TQDM_FORMAT,
     ) as progress:
-        with ThreadPoolExecutor(max_workers=jobs) as executor:
-            pending = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor, ThreadPoolExecutor(
+            max_workers=1
+        ) as upload_executor, ThreadPoolExecutor(max_workers=1) as refresh_executor:
+            pending = set()
             max_pending = max(1, jobs * 2)
 
-            def collect_completed():
-                nonlocal success_count, fail_count, skip_count, post_skip_count
-                completed = []
-                for future in pending:
-                    if not future.done():
-                        continue
-                    completed.append(future)
+            def collect_completed(timeout=0):
+                nonlocal pending, success_count, fail_count, skip_count, post_skip_count
+                if not pending:
+                    if timeout:
+                        time.sleep(timeout)
+                    return
+                completed, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in completed:
                     name, status, result = future.result()
                     filename = f"{name}.mp4"
                     if status == "downloaded":
                         if filename in last_remote_files:
-                            post_skip_count += 1
+                            with batch_lock:
+                                post_skip_count += 1
                         else:
                             success_count += 1
-                            add_to_batch(result)
+                            add_to_batch(filename, result)
                     elif status == "failed":
                         fail_count += 1
                     else:
                         skip_count += 1
                         if isinstance(result, str):
                             if filename in last_remote_files:
-                                post_skip_count += 1
+                                with batch_lock:
+                                    post_skip_count += 1
                             else:
-                                add_to_batch(result)
-                for future in completed:
-                    pending.remove(future)
+                                add_to_batch(filename, result)
                 if completed:
                     maybe_flush()
                     progress.update(n=len(completed))
-                    progress.set_postfix_str(status_text(), refresh=False)
+                    maybe_postfix(progress)
+
+            for filename, file_path in local_files:
+                if filename not in last_remote_files:
+                    add_to_batch(filename, file_path)
+                    maybe_flush()
+            skip_count += len(local_files)
+            progress.update(len(local_files))
+            maybe_postfix(progress)
 
-            for name in video_names:
+            for name, filename in download_names:
                 refresh_if_due(progress)
-                filename = f"{name}.mp4"
-                file_path = os.path.join(args.video_path, filename)
                 if filename in last_remote_files:
                     skip_count += 1
                     progress.update(1)
-                    progress.set_postfix_str(status_text(), refresh=False)
-                    continue
-                if os.path.exists(file_path):
-                    skip_count += 1
-                    add_to_batch(file_path)
-                    maybe_flush()
-                    progress.update(1)
-                    progress.set_postfix_str(status_text(), refresh=False)
                     continue
 
                 while len(pending) >= max_pending:
-                    collect_completed()
+                    collect_completed(timeout=MAX_COMPLETION_WAIT_SECONDS)
                     refresh_if_due(progress)
-                    if len(pending) >= max_pending:
-                        time.sleep(0.2)
 
-                pending.append(executor.submit(download_one, name))
+                pending.add(executor.submit(download_one, name))
                 wait_for_dispatch(collect_completed, lambda: refresh_if_due(progress))
 
             while pending:
-                collect_completed()
+                collect_completed(timeout=MAX_COMPLETION_WAIT_SECONDS)
                 refresh_if_due(progress)
-                if pending:
-                    time.sleep(0.5)
+            maybe_postfix(progress, force=True)
 
-            while batch_entries:
-                if attempt_upload(final=True):
-                    progress.set_postfix_str(status_text(), refresh=False)
-                    continue
+            while True:
+                if upload_future is not None:
+                    upload_future.result()
+                    upload_future = None
+                    maybe_postfix(progress, force=True)
                 refresh_if_due(progress)
-                if not batch_entries:
+                selected = take_entries()
+                if not selected:
                     break
-                time.sleep(0.5)
+                upload_future = upload_executor.submit(attempt_upload, selected, True)
 
+    index_executor.shutdown()
     print(f"Finished. Success: {success_count}. Failed: {fail_count}. Skipped: {skip_count}.")
 
 
@@ -1,8 +1,9 @@
 import argparse
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-from huggingface_hub import HfApi, hf_hub_download
+from huggingface_hub import CommitOperationAdd, HfApi, hf_hub_download
 from tqdm import tqdm
 
 DEFAULT_JSON_FILES = [
@@ -12,29 +13,65 @@ DEFAULT_JSON_FILES = [
 ]
 
 
+def link_or_copy(source, destination):
+    # Cached Hub files never change, so a link can stand in for a copy.
+    source = os.path.realpath(source)
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(source, destination)
+        except OSError:
+            shutil.copy(source, destination)
+
+
 def download_json(repo_id, raw_dir, repo_type):
     os.makedirs(raw_dir, exist_ok=True)
-    for filename in tqdm(DEFAULT_JSON_FILES, ncols=120, desc="Downloading JSON"):
-        remote_path = f"data/{filename}"
-        local_path = os.path.join(raw_dir, filename)
-        cached = hf_hub_download(repo_id, remote_path, repo_type=repo_type)
-        shutil.copy(cached, local_path)
+
+    def download_one(filename):
+        cached = hf_hub_download(repo_id, f"data/{filename}", repo_type=repo_type)
+        link_or_copy(cached, os.path.join(raw_dir, filename))
+
+    with ThreadPoolExecutor(max_workers=len(DEFAULT_JSON_FILES)) as executor:
+        for _ in tqdm(
+            executor.map(download_one, DEFAULT_JSON_FILES),
+            total=len(DEFAULT_JSON_FILES),
+            ncols=120,
+            desc="Downloading JSON",
+        ):
+            pass
     print("Finished.")
 
 
 def upload_json(repo_id, raw_dir, repo_type):
     api = HfApi()
     api.create_repo(repo_id, repo_type=repo_type, exist_ok=True)
-    for filename in tqdm(DEFAULT_JSON_FILES, ncols=120, desc="Uploading JSON"):
+    for filename in DEFAULT_JSON_FILES:
         local_path = os.path.join(raw_dir, filename)
         if not os.path.exists(local_path):
             raise FileNotFoundError(f"Missing JSON file: {local_path}")
-        api.upload_file(
-            path_or_fileobj=local_path,
-            path_in_repo=f"data/{filename}",
-            repo_id=repo_id,
-            repo_type=repo_type,
+
+    def prepare_one(filename):
+        return CommitOperationAdd(path_in_repo=f"data/{filename}", path_or_fileobj=os.path.join(raw_dir, filename))
+
+    with ThreadPoolExecutor(max_workers=len(DEFAULT_JSON_FILES)) as executor:
+        operations = list(
+            tqdm(
+                executor.map(prepare_one, DEFAULT_JSON_FILES),
+                total=len(DEFAULT_JSON_FILES),
+                ncols=120,
+                desc="Hashing JSON",
+            )
         )
+    api.create_commit(
+        repo_id=repo_id,
+        repo_type=repo_type,
+        operations=operations,
+        commit_message=f"Upload {len(operations)} JSON files",
+        num_threads=len(operations),
+    )
     print("Finished.")
 
 
@@ -1,17 +1,18 @@
 import argparse
-import json
 import os
-import tempfile
+from itertools import chain
 
 import ijson
+import orjson
 from huggingface_hub import HfApi
 
 YT_INDEX_NAME = "yt_index.json"
+MAX_IN_MEMORY_JSON_BYTES = 1024 * 1024 * 1024
 
 
-def iter_ids_from_json(path):
+def iter_ids_streaming(path):
     top_level = None
-    with open(path, "r") as handle:
+    with open(path, "rb") as handle:
         for prefix, event, value in ijson.parse(handle):
             if top_level is None:
                 if prefix == "" and event == "start_map":
@@ -24,16 +25,25 @@ def iter_ids_from_json(path):
                 yield str(value)
 
 
+def iter_ids_from_json(path):
+    # orjson holds the whole document in memory; stream sources too large for that.
+    if os.path.getsize(path) > MAX_IN_MEMORY_JSON_BYTES:
+        yield from iter_ids_streaming(path)
+        return
+    with open(path, "rb") as handle:
+        data = orjson.loads(handle.read())
+    if isinstance(data, dict):
+        yield from data
+    elif isinstance(data, list):
+        for item in data:
+            video_id = item.get("id") if isinstance(item, dict) else None
+            if isinstance(video_id, (str, int, float)) and not isinstance(video_id, bool):
+                yield str(video_id)
+
+
 def build_yt_index(sources):
-    ids = []
-    seen = set()
-    for source in sources:
-        for video_id in iter_ids_from_json(source):
-            if video_id in seen:
-                continue
-            seen.add(video_id)
-            ids.append(video_id)
-    return ids
+    # dict keeps first-seen order, so this drops duplicates in one C-level pass.
+    return list(dict.fromkeys(chain.from_iterable(iter_ids_from_json(source) for source in sources)))
 
 
 def main():
@@ -50,17 +60,13 @@ def main():
     api = HfApi()
     api.create_repo(args.hf_repo, repo_type=args.repo_type, exist_ok=True)
 
-    with tempfile.TemporaryDirectory(prefix="yt_index_") as temp_dir:
-        index_path = os.path.join(temp_dir, YT_INDEX_NAME)
-        with open(index_path, "w") as handle:
-            json.dump(yt_index, handle)
-        api.upload_file(
-            path_or_fileobj=index_path,
-            path_in_repo=YT_INDEX_NAME,
-            repo_id=args.hf_repo,
-            repo_type=args.repo_type,
-            commit_message=f"Upload {YT_INDEX_NAME}",
-        )
+    api.upload_file(
+        path_or_fileobj=orjson.dumps(yt_index),
+        path_in_repo=YT_INDEX_NAME,
+        repo_id=args.hf_repo,
+        repo_type=args.repo_type,
+        commit_message=f"Upload {YT_INDEX_NAME}",
+    )
     print(f"Uploaded {YT_INDEX_NAME} with {len(yt_index)} ids.")
 
 